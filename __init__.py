@@ -1,13 +1,25 @@
 from __future__ import annotations
 
-import collections
+import functools
 import html.parser
 import json
+import os
+import re
 import sys
 import traceback
 import typing
 import urllib.parse
 
+try:
+    import lxml.etree
+except ImportError:
+    lxml = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class ParseError(Exception):
     pass
 
@@ -23,80 +35,126 @@ class UnexpectedDataError(ParseError):
 class UnexpectedEndOfFileError(ParseError):
     pass
 
-# FIXME: how do we type annotate this?
-ParseState_ = collections.namedtuple('ParseState', ['buffer', 'start', 'end'])
+class LazyTraceback:
+    # Recorded in info['errors']. Formatting a traceback is expensive, so only do it if someone looks.
+    __slots__ = ('exc', '_formatted')
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+        self._formatted = None
+
+    def __str__(self):
+        if self._formatted is None:
+            self._formatted = ''.join(traceback.format_exception(type(self.exc), self.exc, self.exc.__traceback__))
+        return self._formatted
+
+_ASCII_LOWER = bytes(c | 0x20 if 0x41 <= c <= 0x5a else c for c in range(256))
+
+class ParseState:
+    # Mutable cursor: advancing it updates start in place and returns the same object.
+    # Callers that need to backtrack should save and restore start.
+    __slots__ = ('buffer', 'start', 'end')
 
-class ParseState(ParseState_):
     buffer: bytes
     start: int
     end: int
 
+    def __init__(self, buffer: bytes, start: int, end: int):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+
     def startswith(self, expected: bytes | tuple[bytes, ...]):
-        if isinstance(expected, tuple):
-            for e in expected:
-                if self.startswith(e):
-                    return True
-            return False
-        if not isinstance(expected, bytes):
-            raise TypeError('expected bytes or tuple of bytes')
-        return self.buffer[self.start:self.start + len(expected)] == expected
+        return self.buffer.startswith(expected, self.start, self.end)
 
     def startswithnc(self, expected: bytes | tuple[bytes, ...]):
+        # ASCII case-insensitive; expected must already be lowercase
         if isinstance(expected, tuple):
-            for e in expected:
-                if self.startswithnc(e):
-                    return True
-            return False
+            # lowercase the longest window once and let bytes.startswith try each prefix
+            window = self.buffer[self.start:min(self.start + max(map(len, expected), default=0), self.end)]
+            return window.translate(_ASCII_LOWER).startswith(expected)
         if not isinstance(expected, bytes):
             raise TypeError('expected bytes or tuple of bytes')
-        return self.buffer[self.start:self.start + len(expected)].lower() == expected
+        return self.buffer[self.start:min(self.start + len(expected), self.end)].translate(_ASCII_LOWER) == expected
 
     def peekchar(self) -> int | None:
         if self.start < self.end:
             return self.buffer[self.start]
 
+    def decode(self) -> str:
+        # decode the remaining data through a memoryview so a partial range isn't copied first
+        return str(memoryview(self.buffer)[self.start:self.end], 'utf8', 'surrogateescape')
+
     def skipchar(self) -> ParseState:
         if self.start < self.end:
-            return self._replace(start = self.start + 1)
+            self.start += 1
+            return self
         raise UnexpectedEndOfFileError()
 
-# FIXME: how do we type annotate this?
-StrParseState_ = collections.namedtuple('StrParseState', ['buffer', 'start', 'end'])
+class StrParseState:
+    __slots__ = ('buffer', 'start', 'end')
 
-class StrParseState(StrParseState_):
     buffer: str
     start: int
     end: int
 
-SgmlToken_ = collections.namedtuple('SgmlToken', ['kind', 'tag', 'attr_seq', 'data'])
+    def __init__(self, buffer: str, start: int, end: int):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+
+class SgmlToken:
+    __slots__ = ('kind', 'tag', 'attr_seq', 'data', '_attrs')
 
-class SgmlToken(SgmlToken_):
     kind: str
     tag: str | None
     attr_seq: tuple[tuple[str, str], ...] | None
     data: str | None
 
-    attrs: dict
-
     def __init__(self, kind, tag, attr_seq, data):
-        SgmlToken_.__init__(kind, tag, attr_seq, data)
-        if attr_seq == None:
-            self.attrs = None
-        else:
-            self.attrs = dict(attr_seq)
+        # the tokenizer hands us fresh strings; interning them makes the comparisons against tag and attribute names cheap
+        self.kind = kind
+        self.tag = sys.intern(tag) if tag is not None else None
+        if attr_seq is not None:
+            attr_seq = tuple((sys.intern(attr), value) for attr, value in attr_seq)
+        self.attr_seq = attr_seq
+        self.data = data
+        self._attrs = None
+
+    @property
+    def attrs(self) -> dict | None:
+        # most tokens never look at this, so only build the dict when asked
+        if self._attrs is None and self.attr_seq is not None:
+            self._attrs = dict(self.attr_seq)
+        return self._attrs
 
 class SgmlTokenizer(html.parser.HTMLParser):
     def __init__(self, document, convert_charrefs=True, cdata=None, rcdata=None):
         self.document = document
         self.tokens = []
+        self.append_token = self.tokens.append
+        self.pending_data = []
         if cdata is not None:
             self.CDATA_CONTENT_ELEMENTS = cdata
         if rcdata is not None:
             self.RCDATA_CONTENT_ELEMENTS = cdata
         super().__init__(convert_charrefs=convert_charrefs)
 
+    def updatepos(self, i, j):
+        # HTMLParser counts newlines in every span it consumes to track getpos(), which we never use
+        return j
+
+    def close(self):
+        super().close()
+        self.handle_token(None)
+
     def handle_token(self, kind, tag=None, attrs=None, data=None):
-        self.tokens.append(SgmlToken(kind, tag, attrs, data))
+        if self.pending_data:
+            # a run of text can arrive in several pieces, e.g. around a stray '<'; keep it as one token
+            self.append_token(SgmlToken('data', None, None, ''.join(self.pending_data)))
+            self.pending_data = []
+        if kind is not None:
+            self.append_token(SgmlToken(kind, tag, attrs, data))
 
     def handle_starttag(self, tag, attrs):
         self.handle_token('start', tag, attrs)
@@ -109,7 +167,7 @@ class SgmlTokenizer(html.parser.HTMLParser):
         self.handle_token('end', tag, data='empty')
 
     def handle_data(self, data):
-        self.handle_token('data', data=data)
+        self.pending_data.append(data)
 
     def handle_comment(self, data):
         self.handle_token('comment', data=data)
@@ -118,71 +176,152 @@ class SgmlTokenizer(html.parser.HTMLParser):
         self.handle_token('decl', data=decl)
 
     def handle_pi(self, data):
-        self.tokens.append('pi', data=data)
+        self.handle_token('pi', data=data)
 
     def unknown_decl(self, data):
-        self.tokens.append('unknown', data=data)
+        self.handle_token('unknown', data=data)
+
+# Elements that never have content. html.parser reports no end tag for these unless the start tag is
+# written self-closing, but libxml2 reports an end for every element.
+_VOID_ELEMENTS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'))
+
+class LxmlTokenTarget:
+    # lxml parser target; receives events in document order so we don't need to build a tree
+    def __init__(self, tokens):
+        self.append_token = tokens.append
+        self.pending_data = []
+
+    def handle_token(self, kind, tag=None, attrs=None, data=None):
+        if self.pending_data:
+            # libxml2 may split one text run into several callbacks
+            self.append_token(SgmlToken('data', None, None, ''.join(self.pending_data)))
+            self.pending_data = []
+        if kind is not None:
+            self.append_token(SgmlToken(kind, tag, attrs, data))
+
+    def start(self, tag, attrib):
+        # SgmlToken copies the attributes into its own tuple, so the items view is enough
+        self.handle_token('start', tag, attrib.items())
+
+    def end(self, tag):
+        if tag not in _VOID_ELEMENTS:
+            self.handle_token('end', tag)
+
+    def data(self, data):
+        self.pending_data.append(data)
+
+    def comment(self, text):
+        self.handle_token('comment', data=text)
+
+    def doctype(self, name, pubid, system):
+        self.handle_token('decl', data=f'DOCTYPE {name}')
+
+    def pi(self, target, data=None):
+        self.handle_token('pi', data=f'{target} {data}' if data else target)
 
-# FIXME: how do we type annotate this?
-TokenParseState_ = collections.namedtuple('TokenParseState', ['buffer', 'start', 'end'])
+    def close(self):
+        self.handle_token(None)
+
+class LxmlSgmlTokenizer:
+    # Same interface as SgmlTokenizer, but the scanning is done by libxml2 in C. libxml2 parses into a tree,
+    # so on malformed markup the tokens differ: implied and unclosed elements get start/end tokens, stray
+    # end tags are dropped, valueless attributes come through as '' and self-closing tags can't be told apart.
+    def __init__(self, document, encoding=None):
+        self.document = document
+        self.tokens = []
+        self.parser = lxml.etree.HTMLParser(target=LxmlTokenTarget(self.tokens), encoding=encoding)
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def close(self):
+        self.parser.close()
+
+if lxml is not None:
+    DefaultSgmlTokenizer = LxmlSgmlTokenizer
+else:
+    DefaultSgmlTokenizer = SgmlTokenizer
+
+class TokenParseState:
+    __slots__ = ('buffer', 'start', 'end')
 
-class TokenParseState(TokenParseState_):
     buffer: list[SgmlToken]
     start: int
     end: int
 
+    def __init__(self, buffer: list[SgmlToken], start: int, end: int):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+
     def peektoken(self) -> int | None:
         if self.start < self.end:
             return self.buffer[self.start]
         raise UnexpectedEndOfFileError()
 
-    def skiptoken(self) -> ParseState:
+    def skiptoken(self) -> TokenParseState:
         if self.start < self.end:
-            return self._replace(start = self.start + 1)
+            self.start += 1
+            return self
         raise UnexpectedEndOfFileError()
 
 def parse_expectnc(data: ParseState, expected: bytes) -> ParseState:
     if not data.startswithnc(expected):
         raise UnexpectedDataError(f'Expected {repr(expected)}, got {repr(data.buffer[data.start:data.start+len(expected)])} at byte {data.start}')
-    return data._replace(start = data.start + len(expected))
+    data.start += len(expected)
+    return data
 
 def parse_expect(data: ParseState, expected: bytes) -> ParseState:
     if not data.startswith(expected):
         raise UnexpectedDataError(f'Expected {repr(expected)}, got {repr(data.buffer[data.start:data.start+len(expected)])} at byte {data.start}')
-    return data._replace(start = data.start + len(expected))
+    data.start += len(expected)
+    return data
+
+_WS_RE = re.compile(rb'[\t\n\x0c\r ]+')
 
 def parse_ascii_whitespace(data: ParseState) -> ParseState:
-    if not data.peekchar() in (9, 10, 12, 13, 32):
-        raise UnexpectedDataError(f'Expected ascii whitespace, got {repr(data.peekchar)} at byte {data.start}')
-    data = data.skipchar()
-    while data.peekchar() in (9, 10, 12, 13, 32):
-        data = data.skipchar()
+    m = _WS_RE.match(data.buffer, data.start, data.end)
+    if m is None:
+        raise UnexpectedDataError(f'Expected ascii whitespace, got {repr(data.peekchar())} at byte {data.start}')
+    data.start = m.end()
     return data
 
+# lowercase, as startswithnc requires
+_DOCTYPE_PREFIX = b'<!doctype'
+
+_DOCTYPE_NAME_RE = re.compile(rb'[^\t\n\x0c\r >]+')
+
 def parse_sgml_doctype(data: ParseState, info: dict) -> (ParseState, dict):
-    data = parse_expectnc(data, b'<!doctype')
+    data = parse_expectnc(data, _DOCTYPE_PREFIX)
     data = parse_ascii_whitespace(data)
-    typename_firstchar = data.peekchar()
-    if typename_firstchar in (9, 10, 12, 13, 32, 62):
-        raise UnexpectedDataError(f'Expected a document type name, got {repr(data.peekchar)} at byte {data.start}')
-    typename = [typename_firstchar]
-    data = data.skipchar()
-    while data.peekchar() not in (9, 10, 12, 13, 32, 62):
-        typename.append(data.peekchar())
-        data = data.skipchar()
-    info['document_type_name'] = bytes(typename).decode('utf8', errors='surrogateescape')
+    m = _DOCTYPE_NAME_RE.match(data.buffer, data.start, data.end)
+    if m is None:
+        raise UnexpectedDataError(f'Expected a document type name, got {repr(data.peekchar())} at byte {data.start}')
+    info['document_type_name'] = m.group().decode('utf8', errors='surrogateescape')
+    data.start = m.end()
     data = parse_expect(data, b'>') # TODO: handle external identifier
     return data, info
 
+# Set WEBPARSE_DEBUG=1 to include a full traceback with each recorded parse error.
+_DEBUG = os.environ.get('WEBPARSE_DEBUG', '') not in ('', '0')
+
+def record_error(info: dict, exc: ParseError):
+    error = {'type': type(exc).__name__, 'msg': str(exc)}
+    if _DEBUG:
+        error['traceback'] = LazyTraceback(exc)
+    append_object(info, 'errors', error)
+
 def get_object(data: dict, name: str) -> dict:
-    if name not in data:
-        data[name] = {}
-    return data[name]
+    obj = data.get(name)
+    if obj is None:
+        obj = data[name] = {}
+    return obj
 
 def append_object(data: dict, name: str, item):
-    if name not in data:
-        data[name] = []
-    data[name].append(item)
+    lst = data.get(name)
+    if lst is None:
+        lst = data[name] = []
+    lst.append(item)
 
 def tokenparse_html_title(data: TokenParseState, info: dict) -> tuple[TokenParseState, dict]:
     open_token = data.peektoken()
@@ -201,21 +340,33 @@ def tokenparse_html_title(data: TokenParseState, info: dict) -> tuple[TokenParse
     get_object(info, 'html')['title'] = content_token.data.strip()
     return data, info
 
+if orjson is not None:
+    # orjson rejects some input json accepts (NaN, lone surrogates left by undecodable bytes)
+    # and turns integers too big for 64 bits into floats, so leave those to json
+    _LONG_DIGITS_RE = re.compile(r'[0-9]{19}')
+
+    def _json_loads(content: str):
+        if _LONG_DIGITS_RE.search(content) is None:
+            try:
+                return orjson.loads(content)
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(content)
+else:
+    _json_loads = json.loads
+
+_SCRIPT_KNOWN = frozenset(('type', 'src'))
+
 def tokenparse_html_script(data: TokenParseState, info: dict) -> tuple[TokenParseState, dict]:
     open_token = data.peektoken()
     data = data.skiptoken()
 
     script = {}
     for attr, value in open_token.attr_seq:
-        if attr == 'type':
-            script['type'] = value
+        if attr in _SCRIPT_KNOWN:
+            script[attr] = value
             continue
-        if attr == 'src':
-            script['src'] = value
-            continue
-        if 'attrs' not in script:
-            script['attrs'] = []
-        script['attrs'].append((attr, value))
+        append_object(script, 'attrs', (attr, value))
 
     next_token = data.peektoken()
     if next_token.kind == 'data':
@@ -231,7 +382,7 @@ def tokenparse_html_script(data: TokenParseState, info: dict) -> tuple[TokenPars
         data = data.skiptoken()
 
     if script.get('type', '').endswith('+json') and 'content' in script:
-        script['json'] = json.loads(script['content'])
+        script['json'] = _json_loads(script['content'])
         
         if script['type'] == 'application/ld+json':
             if 'json_ld' not in info:
@@ -243,30 +394,18 @@ def tokenparse_html_script(data: TokenParseState, info: dict) -> tuple[TokenPars
     append_object(get_object(info, 'html'), 'scripts', script)
     return data, info
 
+_STYLE_KNOWN = frozenset(('blocking', 'media', 'nonce', 'title', 'type'))
+
 def tokenparse_html_style(data: TokenParseState, info: dict) -> tuple[TokenParseState, dict]:
     open_token = data.peektoken()
     data = data.skiptoken()
 
     style = {}
     for attr, value in open_token.attr_seq:
-        if attr == 'blocking':
-            style['blocking'] = value
-            continue
-        if attr == 'media':
-            style['media'] = value
-            continue
-        if attr == 'nonce':
-            style['nonce'] = value
-            continue
-        if attr == 'title':
-            style['title'] = value
-            continue
-        if attr == 'type':
-            style['type'] = value
+        if attr in _STYLE_KNOWN:
+            style[attr] = value
             continue
-        if 'attrs' not in style:
-            style['attrs'] = []
-        style['attrs'].append((attr, value))
+        append_object(style, 'attrs', (attr, value))
 
     next_token = data.peektoken()
     data = data.skiptoken()
@@ -283,19 +422,38 @@ def tokenparse_html_style(data: TokenParseState, info: dict) -> tuple[TokenParse
     append_object(get_object(info, 'html'), 'styles', style)
     return data, info
 
+def object_urls(obj: dict) -> set:
+    # url and sameAs come straight from the page, so each may be a single string or a list
+    urls = set()
+    for value in (obj.get('url'), obj.get('sameAs')):
+        if isinstance(value, str):
+            urls.add(value)
+        elif isinstance(value, list):
+            urls.update(url for url in value if isinstance(url, str))
+    return urls
+
+def cached_object_urls(obj: dict) -> set:
+    # objects compared more than once keep their url set in '_url_set'; whoever
+    # passes them to object_matches has to remove it before they reach the output
+    urls = obj.get('_url_set')
+    if urls is None:
+        urls = obj['_url_set'] = object_urls(obj)
+    return urls
+
 def object_matches(obj: dict, ld: dict):
-    if obj.get('name') == ld.get('name'):
+    name = obj.get('name')
+    if name is not None and name == ld.get('name'):
         return True
-    obj_urls = set(([obj['url']] if 'url' in obj else []) + (obj.get('sameAs') or []))
-    ld_urls = set(([ld['url']] if 'url' in ld else []) + (ld.get('sameAs') or []))
-    if obj_urls & ld_urls:
+    url = obj.get('url')
+    if url is not None and url == ld.get('url'):
         return True
-    return False
+    if not obj.get('sameAs') and not ld.get('sameAs'):
+        # only the urls could match, and they didn't
+        return False
+    return not cached_object_urls(obj).isdisjoint(cached_object_urls(ld))
 
 def add_main_author(info, author):
-    if 'main_content' not in info:
-        info['main_content'] = {}
-    main_content = info['main_content']
+    main_content = get_object(info, 'main_content')
     if 'author' not in main_content:
         main_content['author'] = []
     for orig_author in main_content['author']:
@@ -304,13 +462,20 @@ def add_main_author(info, author):
     else:
         orig_author = {}
         main_content['author'].append(orig_author)
+    author.pop('_url_set', None)
     for key, val in author.items():
         if key == 'sameAs' and 'sameAs' in orig_author:
-            for url in val:
-                if url not in orig_author['sameAs']:
-                    orig_author['sameAs'].append(url)
+            # either side may be a single url rather than a list
+            same_as = orig_author['sameAs']
+            if not isinstance(same_as, list):
+                same_as = orig_author['sameAs'] = [same_as]
+            for url in (val if isinstance(val, list) else [val]):
+                if url not in same_as:
+                    same_as.append(url)
             continue
         orig_author[key] = val
+    # the urls may have changed, so let object_matches rebuild the cache
+    orig_author.pop('_url_set', None)
 
 def fill_from_json_ld(info: dict, ld: list) -> dict:
     # This is really complicated. We don't want to make additional requests or get bogged down in details, so just handle simple cases.
@@ -320,9 +485,7 @@ def fill_from_json_ld(info: dict, ld: list) -> dict:
 
     ld = ld[0]
 
-    if 'main_content' not in info:
-        info['main_content'] = {}
-    main_content = info['main_content']
+    main_content = get_object(info, 'main_content')
 
     main_content['json_ld'] = ld
 
@@ -369,19 +532,19 @@ def fill_from_json_ld(info: dict, ld: list) -> dict:
         else:
             orig_feed = {}
             main_content['containing_feeds'].append(orig_feed)
+        pub.pop('_url_set', None)
         if 'name' in pub:
             orig_feed['name'] = pub['name']
         if 'url' in pub:
             orig_feed['url'] = pub['url']
             orig_feed['url_has_info'] = ['unknown']
         orig_feed['json_ld'] = pub
+        orig_feed.pop('_url_set', None)
 
     return info
 
 def set_main_description(info: dict, description: dict):
-    if 'main_content' not in info:
-        info['main_content'] = {}
-    main_content = info['main_content']
+    main_content = get_object(info, 'main_content')
     if 'description' not in main_content:
         main_content['description'] = description
 
@@ -390,21 +553,23 @@ def tokenparse_html_contentlist(data: TokenParseState, info: dict, parent: dict,
     try:
         result = []
         unknowns = []
+        open_tags = info['_open_tags']
         token = data.peektoken()
-        while data.peektoken().kind != 'end' or data.peektoken().tag not in info['_open_tags']:
+        while token.kind != 'end' or token.tag not in open_tags:
+            start = data.start
             try:
-                data, info, content = tokenparse_html_content(data, info, parent)
-                if content is not None:
+                data, info, content, recognized = tokenparse_html_content(data, info, parent)
+                if not recognized:
+                    result.append({'kind': token.kind, 'tag': token.tag, 'attrs': token.attr_seq, 'data': token.data})
+                    data = data.skiptoken()
+                elif content is not None:
                     result.append(content)
-            except UnrecognizedDataError:
-                result.append({'kind': token.kind, 'tag': token.tag, 'attrs': token.attr_seq, 'data': token.data})
-                data = data.skiptoken()
-            except ParseError:
-                append_object(info, 'errors', traceback.format_exc())
+            except ParseError as e:
+                record_error(info, e)
+                data.start = start
                 data = data.skiptoken()
             token = data.peektoken()
-        token = data.peektoken()
-        if token.kind == 'end' and token.tag == closingtag:
+        if token.tag == closingtag:
             data = data.skiptoken()
         else:
             result.append({'kind': 'error', 'error': 'No closing tag'})
@@ -412,6 +577,8 @@ def tokenparse_html_contentlist(data: TokenParseState, info: dict, parent: dict,
     finally:
         info['_open_tags'].pop(-1)
 
+_SVG_KNOWN = frozenset(('baseprofile', 'height', 'preserveAspectRatio', 'version', 'viewbox', 'width', 'x', 'y'))
+
 def tokenparse_svg(data: TokenParseState, info: dict, parent: dict) -> tuple[TokenParseState, dict, dict]:
     token = data.peektoken()
     data = data.skiptoken()
@@ -419,235 +586,265 @@ def tokenparse_svg(data: TokenParseState, info: dict, parent: dict) -> tuple[Tok
     unknown_token_list = []
     if token.attr_seq:
         for key, value in token.attr_seq:
-            if key in ('baseprofile', 'height', 'preserveAspectRatio', 'version', 'viewbox', 'width', 'x', 'y'):
+            if key in _SVG_KNOWN:
                 result[key] = value
-        else:
-            append_object(result, 'attrs', (key, value))
+            else:
+                append_object(result, 'attrs', (key, value))
     contents = []
-    while data.peektoken().kind != 'end' or data.peektoken().tag != 'svg':
-        token = data.peektoken()
+    token = data.peektoken()
+    while token.kind != 'end' or token.tag != 'svg':
         if token.kind == 'start' and token.tag == 'svg':
             data, info, nested = tokenparse_svg(data, info, result)
             contents.append(nested)
         else:
             contents.append({'kind': token.kind, 'tag': token.tag, 'attrs': token.attr_seq, 'data': token.data})
             data = data.skiptoken()
+        token = data.peektoken()
     data = data.skiptoken()
     result['contents'] = contents
     return data, info, result
 
-def tokenparse_html_content(data: TokenParseState, info: dict, parent: dict) -> tuple[TokenParseState, dict, dict | None]:
+# Start tags that become a content node holding everything up to the matching end tag, mapped to the node's kind
+_CONTENT_CONTAINERS = {
+    'div': 'div',
+    'a': 'anchor',
+    'noscript': 'noscript',
+    'header': 'header',
+    'button': 'button',
+}
+
+def tokenparse_html_content(data: TokenParseState, info: dict, parent: dict) -> tuple[TokenParseState, dict, dict | None, bool]:
     # here we handle anything that could potentially be content: divs, paragraphs, spans, text, images
+    # the last element of the result is False if the token isn't content, in which case nothing was consumed
     token = data.peektoken()
-    if token.kind == 'start':
-        if token.tag == 'div':
-            data = data.skiptoken()
-            result = {'kind': 'div'}
-            unknown_token_list = []
-            if token.attr_seq:
-                result['attrs'] = token.attr_seq
-            data, info, contentlist = tokenparse_html_contentlist(data, info, result, 'div')
-            result['contents'] = contentlist
-            return data, info, result
-        if token.tag == 'a':
-            data = data.skiptoken()
-            result = {'kind': 'anchor'}
-            unknown_token_list = []
-            if token.attr_seq:
-                result['attrs'] = token.attr_seq
-            data, info, contentlist = tokenparse_html_contentlist(data, info, result, 'a')
-            result['contents'] = contentlist
-            return data, info, result
-        if token.tag == 'noscript':
-            data = data.skiptoken()
-            result = {'kind': 'noscript'}
-            unknown_token_list = []
-            if token.attr_seq:
-                result['attrs'] = token.attr_seq
-            data, info, contentlist = tokenparse_html_contentlist(data, info, result, 'noscript')
-            result['contents'] = contentlist
-            return data, info, result
-        if token.tag == 'svg':
-            return tokenparse_svg(data, info, parent)
-        if token.tag == 'header':
-            data = data.skiptoken()
-            result = {'kind': 'header'}
-            unknown_token_list = []
-            if token.attr_seq:
-                result['attrs'] = token.attr_seq
-            data, info, contentlist = tokenparse_html_contentlist(data, info, result, 'header')
-            result['contents'] = contentlist
-            return data, info, result
-        if token.tag == 'button':
-            data = data.skiptoken()
-            result = {'kind': 'button'}
-            unknown_token_list = []
-            if token.attr_seq:
-                result['attrs'] = token.attr_seq
-            data, info, contentlist = tokenparse_html_contentlist(data, info, result, 'button')
+    kind = token.kind
+    if kind == 'start':
+        tag = token.tag
+        container_kind = _CONTENT_CONTAINERS.get(tag)
+        if container_kind is not None:
+            # error recovery retries the same container from each enclosing level, so remember
+            # the outcome for this position and set of open tags
+            memo = get_object(info, '_content_memo')
+            key = (data.start, tuple(info.get('_open_tags', ())))
+            cached = memo.get(key)
+            if cached is not None:
+                end, result = cached
+                if end is None:
+                    # keep only the error's type and args, so each retry records its own exception
+                    error_type, error_args = result
+                    raise error_type(*error_args)
+                data.start = end
+                return data, info, result, True
+            try:
+                data = data.skiptoken()
+                result = {'kind': container_kind}
+                if token.attr_seq:
+                    result['attrs'] = token.attr_seq
+                data, info, contentlist = tokenparse_html_contentlist(data, info, result, tag)
+            except ParseError as e:
+                memo[key] = (None, (type(e), e.args))
+                raise
             result['contents'] = contentlist
-            return data, info, result
-    if token.kind == 'data' and token.data.isspace() and not parent.get('preserve_whitespace'):
+            memo[key] = (data.start, result)
+            return data, info, result, True
+        if tag == 'svg':
+            data, info, result = tokenparse_svg(data, info, parent)
+            return data, info, result, True
+    if kind == 'data' and token.data.isspace() and not parent.get('preserve_whitespace'):
         data = data.skiptoken()
-        return data, info, None
-    raise UnrecognizedDataError()
+        return data, info, None, True
+    return data, info, None, False
+
+# Handlers for start tags at the top level. Each returns (data, info), or None to fall
+# through to the generic handling in tokenparse_html_toplevel.
+
+_HTML_ATTR_KEYS = {'id': 'html_id', 'class': 'html_class'}
+
+def _handle_html(token: SgmlToken, data: TokenParseState, info: dict) -> tuple[TokenParseState, dict] | None:
+    if token.attr_seq:
+        h = get_object(info, 'html')
+        for attr, value in token.attr_seq:
+            key = _HTML_ATTR_KEYS.get(attr)
+            if key is not None:
+                h[key] = value
+                continue
+            append_object(h, 'html_unknown_attrs', (attr, value))
+    return data.skiptoken(), info
+
+def _handle_head(token: SgmlToken, data: TokenParseState, info: dict) -> tuple[TokenParseState, dict] | None:
+    for attr, value in token.attr_seq:
+        append_object(get_object(info, 'html'), 'head_attrs', (attr, value))
+        continue
+    return data.skiptoken(), info
+
+def _handle_body(token: SgmlToken, data: TokenParseState, info: dict) -> tuple[TokenParseState, dict] | None:
+    for attr, value in token.attr_seq:
+        append_object(get_object(info, 'html'), 'body_attrs', (attr, value))
+        continue
+    return data.skiptoken(), info
+
+def _handle_script(token: SgmlToken, data: TokenParseState, info: dict) -> tuple[TokenParseState, dict] | None:
+    start = data.start
+    try:
+        data, info = tokenparse_html_script(data, info)
+        return data, info
+    except ParseError as e:
+        data.start = start
+        record_error(info, e)
+
+# Pages tend to repeat the same few links, so remember recent joins across calls.
+_cached_urljoin = functools.lru_cache(maxsize=256)(urllib.parse.urljoin)
+
+def resolve_url(info: dict, href: str) -> str:
+    # Same result as urljoin(info['base_url'], href), but the base URL is only split once per document.
+    base_url = info.get('base_url', '')
+    if not base_url:
+        return href
+    base_split = info.get('_base_split')
+    if base_split is None or base_split[0] != base_url:
+        base_split = info['_base_split'] = (base_url, urllib.parse.urlsplit(base_url))
+    base = base_split[1]
+    if href[:1] == '/' and href[1:2] != '/' and base.scheme in urllib.parse.uses_relative and base.scheme in urllib.parse.uses_netloc:
+        # rooted path: only the scheme and host come from the base, unless there are dot segments to resolve
+        split = urllib.parse.urlsplit(href)
+        # urlsplit drops tabs and newlines, so something like '/\n/host' can still turn out to have a host
+        if not split.netloc and '/.' not in split.path:
+            return urllib.parse.urlunsplit((base.scheme, base.netloc, split.path, split.query, split.fragment))
+    return _cached_urljoin(base_url, href)
+
+_LINK_KNOWN = frozenset(('rel', 'href', 'type', 'title'))
+
+def _handle_link(token: SgmlToken, data: TokenParseState, info: dict) -> tuple[TokenParseState, dict] | None:
+    link = {}
+    sizes = None
+    for attr, value in token.attr_seq:
+        if attr in _LINK_KNOWN:
+            link[attr] = value
+            continue
+        if attr == 'sizes':
+            sizes = value
+        append_object(link, 'attrs', (attr, value))
+    append_object(get_object(info, 'html'), 'links', link)
+    if link.get('rel') == 'canonical' and 'url' not in info and 'href' in link:
+        info['url'] = link['href']
+    if link.get('rel') == 'canonical' and 'base_url' not in info and 'href' in link:
+        info['base_url'] = link['href']
+    if link.get('rel') == 'alternate' and link.get('type') == 'application/rss+xml' and 'href' in link:
+        href = resolve_url(info, link['href'])
+        main_content = get_object(info, 'main_content')
+        feed = {
+            'url': href,
+            'url_has_info': ['name', 'description', 'unknown'],
+            'html_link': link,
+            }
+        if 'title' in link:
+            feed['name'] = link['title']
+        else:
+            feed['generic_name'] = "RSS Feed"
+        append_object(main_content, 'containing_feeds', feed)
+    if link.get('rel') in ('icon', 'shortcut icon', 'apple-touch-icon') and 'href' in link:
+        if sizes is not None:
+            if sizes == 'any':
+                this_size = "any"
+            else:
+                this_size = int(sizes.split('x')[0])
+        elif link['rel'] == 'apple-touch-icon':
+            this_size = 192
+        else:
+            this_size = 16
+        if 'favicon' not in info or (info['favicon']['size'] != 'any' and (this_size == 'any' or this_size > info['favicon']['size'])):
+            href = resolve_url(info, link['href'])
+            info['favicon'] = {
+                'size': this_size,
+                'url': href,
+            }
+    return data.skiptoken(), info
+
+def _handle_meta(token: SgmlToken, data: TokenParseState, info: dict) -> tuple[TokenParseState, dict] | None:
+    append_object(get_object(info, 'html'), 'metas', token.attrs)
+    name = token.attrs.get('name') or token.attrs.get('http-equiv') or token.attrs.get('itemprop') or token.attrs.get('property')
+    if name in ('description', 'og:description') and 'content' in token.attrs:
+        set_main_description(info, {'text': token.attrs['content']})
+    if name == 'sailthru.author' and 'content' in token.attrs:
+        add_main_author(info, {'name': token.attrs['content']})
+    if name == 'og:type' and token.attrs.get('content') == 'article':
+        get_object(info, 'main_content')['kind'] = 'article'
+    if name == 'og:title' and 'content' in token.attrs:
+        get_object(info, 'main_content')['title'] = token.attrs['content']
+    if name == 'og:url' and 'content' in token.attrs:
+        if 'url' not in info:
+            info['url'] = token.attrs['content']
+        if 'base_url' not in info:
+            info['base_url'] = token.attrs['content']
+    return data.skiptoken(), info
+
+def _handle_title(token: SgmlToken, data: TokenParseState, info: dict) -> tuple[TokenParseState, dict] | None:
+    start = data.start
+    try:
+        data, info = tokenparse_html_title(data, info)
+        return data, info
+    except ParseError as e:
+        data.start = start
+        record_error(info, e)
+
+def _handle_style(token: SgmlToken, data: TokenParseState, info: dict) -> tuple[TokenParseState, dict] | None:
+    start = data.start
+    try:
+        data, info = tokenparse_html_style(data, info)
+        return data, info
+    except ParseError as e:
+        data.start = start
+        record_error(info, e)
+
+_START_DISPATCH = {
+    'html': _handle_html,
+    'head': _handle_head,
+    'body': _handle_body,
+    'script': _handle_script,
+    'link': _handle_link,
+    'meta': _handle_meta,
+    'title': _handle_title,
+    'style': _handle_style,
+}
+
+_END_SKIP = frozenset(('html', 'head', 'link', 'meta', 'body'))
 
 def tokenparse_html_toplevel(data: TokenParseState, info: dict) -> tuple[TokenParseState, dict]:
     token = data.peektoken()
-    if token.kind == 'start':
-        if token.tag == 'html':
-            for attr, value in token.attr_seq:
-                h = get_object(info, 'html')
-                if attr == 'id':
-                    h['html_id'] = value
-                    continue
-                if attr == 'class':
-                    h['html_class'] = value
-                    continue
-                append_object(h, 'html_unknown_attrs', (attr, value))
-                continue
+    kind = token.kind
+    start = data.start
+    if kind == 'start':
+        handler = _START_DISPATCH.get(token.tag)
+        if handler is not None:
+            result = handler(token, data, info)
+            if result is not None:
+                return result
+    elif kind == 'end':
+        if token.tag in _END_SKIP:
             return data.skiptoken(), info
-        if token.tag == 'head':
-            for attr, value in token.attr_seq:
-                append_object(get_object(info, 'html'), 'head_attrs', (attr, value))
-                continue
-            return data.skiptoken(), info
-        if token.tag == 'body':
-            for attr, value in token.attr_seq:
-                append_object(get_object(info, 'html'), 'body_attrs', (attr, value))
-                continue
-            return data.skiptoken(), info
-        if token.tag == 'script':
-            try:
-                data, info = tokenparse_html_script(data, info)
-                return data, info
-            except ParseError:
-                if 'errors' not in info:
-                    info['errors'] = []
-                info['errors'].append(traceback.format_exc())
-        if token.tag == 'link':
-            link = {}
-            for attr, value in token.attr_seq:
-                if attr == 'rel':
-                    link['rel'] = value
-                    continue
-                if attr == 'href':
-                    link['href'] = value
-                    continue
-                if attr == 'type':
-                    link['type'] = value
-                    continue
-                if attr == 'title':
-                    link['title'] = value
-                    continue
-                if 'attrs' not in link:
-                    link['attrs'] = []
-                link['attrs'].append((attr, value))
-            append_object(get_object(info, 'html'), 'links', link)
-            if link.get('rel') == 'canonical' and 'url' not in info and 'href' in link:
-                info['url'] = link['href']
-            if link.get('rel') == 'canonical' and 'base_url' not in info and 'href' in link:
-                info['base_url'] = link['href']
-            if link.get('rel') == 'alternate' and link.get('type') == 'application/rss+xml' and 'href' in link:
-                href = urllib.parse.urljoin(info.get('base_url', ''), link['href'])
-                if 'main_content' not in info:
-                    info['main_content'] = {}
-                main_content = info['main_content']
-                feed = {
-                    'url': href,
-                    'url_has_info': ['name', 'description', 'unknown'],
-                    'html_link': link,
-                    }
-                if 'title' in link:
-                    feed['name'] = link['title']
-                else:
-                    feed['generic_name'] = "RSS Feed"
-                if 'containing_feeds' not in main_content:
-                    main_content['containing_feeds'] = []
-                main_content['containing_feeds'].append(feed)
-            if link.get('rel') in ('icon', 'shortcut icon', 'apple-touch-icon') and 'href' in link:
-                if 'sizes' in token.attrs:
-                    if token.attrs['sizes'] == 'any':
-                        this_size = "any"
-                    else:
-                        this_size = int(link.attrs['sizes'].split('x')[0])
-                elif link['rel'] == 'apple-touch-icon':
-                    this_size = 192
-                else:
-                    this_size = 16
-                if 'favicon' not in info or (info['favicon']['size'] != 'any' and (this_size == 'any' or this_size > info['favicon']['size'])):
-                    href = urllib.parse.urljoin(info.get('base_url', ''), link['href'])
-                    info['favicon'] = {
-                        'size': this_size,
-                        'url': href,
-                    }
-            return data.skiptoken(), info
-        if token.tag == 'meta':
-            append_object(get_object(info, 'html'), 'metas', token.attrs)
-            name = token.attrs.get('name') or token.attrs.get('http-equiv') or token.attrs.get('itemprop') or token.attrs.get('property')
-            if name in ('description', 'og:description') and 'content' in token.attrs:
-                set_main_description(info, {'text': token.attrs['content']})
-            if name == 'sailthru.author' and 'content' in token.attrs:
-                add_main_author(info, {'name': token.attrs['content']})
-            if name == 'og:type' and token.attrs.get('content') == 'article':
-                if 'main_content' not in info:
-                    info['main_content'] = {}
-                info['main_content']['kind'] = 'article'
-            if name == 'og:title' and 'content' in token.attrs:
-                if 'main_content' not in info:
-                    info['main_content'] = {}
-                info['main_content']['title'] = token.attrs['content']
-            if name == 'og:url' and 'content' in token.attrs:
-                if 'url' not in info:
-                    info['url'] = token.attrs['content']
-                if 'base_url' not in info:
-                    info['base_url'] = token.attrs['content']
-            return data.skiptoken(), info
-        if token.tag == 'title':
-            try:
-                data, info = tokenparse_html_title(data, info)
-                return data, info
-            except ParseError:
-                if 'errors' not in info:
-                    info['errors'] = []
-                info['errors'].append(traceback.format_exc())
-        if token.tag == 'style':
-            try:
-                data, info = tokenparse_html_style(data, info)
-                return data, info
-            except ParseError:
-                if 'errors' not in info:
-                    info['errors'] = []
-                info['errors'].append(traceback.format_exc())
-    if token.kind == 'end':
-        if token.tag in ('html', 'head', 'link', 'meta', 'body'):
-            return data.skiptoken(), info
-    if token.kind == 'decl':
+    elif kind == 'decl':
         # Assume the doctype has already been handled
         return data.skiptoken(), info
     try:
-        data, info, new_content = tokenparse_html_content(data, info, info)
-        if new_content is not None:
-            append_object(get_object(info, 'html'), 'content', new_content)
-        return data, info
-    except UnrecognizedDataError:
-        pass
-    except ParseError:
-        append_object(info, 'errors', traceback.format_exc())
-    if token.kind == 'data':
+        data, info, new_content, recognized = tokenparse_html_content(data, info, info)
+        if recognized:
+            if new_content is not None:
+                append_object(get_object(info, 'html'), 'content', new_content)
+            return data, info
+    except ParseError as e:
+        data.start = start
+        record_error(info, e)
+    if kind == 'data':
         if token.data.isspace():
             # whitespace
             return data.skiptoken(), info
-    if token.kind == 'comment':
+    elif kind == 'comment':
         append_object(get_object(info, 'html'), 'comments', token.data)
         return data.skiptoken(), info
     # unrecognized data
     data = data.skiptoken()
 
-    if 'unknown_tokens' not in info:
-        info['unknown_tokens'] = []
-
-    info['unknown_tokens'].append({'kind': token.kind, 'tag': token.tag, 'attrs': token.attr_seq, 'data': token.data})
+    append_object(info, 'unknown_tokens', {'kind': token.kind, 'tag': token.tag, 'attrs': token.attr_seq, 'data': token.data})
 
     return data, info
 
@@ -656,8 +853,15 @@ def tokenparse_html(data: TokenParseState, info: dict) -> dict:
         data, info = tokenparse_html_toplevel(data, info)
     if '_open_tags' in info:
         del info['_open_tags']
+    if '_base_split' in info:
+        del info['_base_split']
+    if '_content_memo' in info:
+        del info['_content_memo']
     if 'json_ld' in info:
         info = fill_from_json_ld(info, info['json_ld'])
+    for key in ('author', 'containing_feeds'):
+        for obj in info.get('main_content', {}).get(key, ()):
+            obj.pop('_url_set', None)
     if 'title' not in info.get('main_content', ()) and 'title' in info.get('html', ()):
         # This is likely to have nothing to do with the content, so it's a last resort
         get_object(info, 'main_content')['title'] = info['html']['title']
@@ -665,8 +869,9 @@ def tokenparse_html(data: TokenParseState, info: dict) -> dict:
 
 def strparse_html(data: StrParseState, info: dict) -> dict:
     document = data.buffer[data.start:data.end]
-    parser = SgmlTokenizer(document)
+    parser = DefaultSgmlTokenizer(document)
     parser.feed(document)
+    parser.close()
     tokens = parser.tokens
 
     token_data = TokenParseState(tokens, 0, len(tokens))
@@ -674,22 +879,36 @@ def strparse_html(data: StrParseState, info: dict) -> dict:
 
     return info
 
+_LXML_FEED_SIZE = 65536
+
 def parse_html(data: ParseState, info: dict) -> dict:
     # TODO: use a passed in encoding or detect encoding from content
-    string_data = data.buffer[data.start:data.end].decode('utf8', errors='surrogateescape')
-    string_data = StrParseState(string_data, 0, len(string_data))
-    string_data, info = strparse_html(string_data, info)
-    if string_data.start != string_data.end:
-        info['trailing_data'] = string_data.buffer[string_data.start:string_data.end]
+    if DefaultSgmlTokenizer is LxmlSgmlTokenizer:
+        # libxml2 decodes the bytes itself, so don't build a str of the whole document first.
+        # lxml won't take a memoryview, so feed it in pieces rather than copying the whole range.
+        parser = LxmlSgmlTokenizer(data.buffer, encoding='utf-8')
+        if data.start < data.end:
+            # libxml2 fails on close if it was never fed anything, e.g. when the document ends at the DOCTYPE
+            for i in range(data.start, data.end, _LXML_FEED_SIZE):
+                parser.feed(data.buffer[i:min(i + _LXML_FEED_SIZE, data.end)])
+            parser.close()
+        token_data = TokenParseState(parser.tokens, 0, len(parser.tokens))
+        token_data, info = tokenparse_html(token_data, info)
+    else:
+        string_data = data.decode()
+        string_data = StrParseState(string_data, 0, len(string_data))
+        token_data, info = strparse_html(string_data, info)
+    if token_data.start != token_data.end:
+        info['trailing_data'] = token_data.buffer[token_data.start:token_data.end]
     return info
 
 def parse_unknown(data: ParseState, info: dict) -> (ParseState, dict):
-    if data.startswithnc(b'<!doctype'):
-        full_data = data
+    if data.startswithnc(_DOCTYPE_PREFIX):
         data, info = parse_sgml_doctype(data, info)
         if info['document_type_name'].lower() == 'html':
-            info = parse_html(full_data, info)
-            data = full_data._replace(start = full_data.end)
+            # the doctype is already handled, so only tokenize what follows it
+            info = parse_html(data, info)
+            data.start = data.end
         return data, info
     raise UnrecognizedPreambleError(repr(data.buffer[data.start:data.start+256]))
 
@@ -697,7 +916,7 @@ def parse_bytes(buffer: bytes, info: dict) -> dict:
     data = ParseState(buffer, 0, len(buffer))
     data, info = parse_unknown(data, {})
     if data.start != data.end:
-        info['trailing_data'] = data.buffer[data.start:data.end].decode('utf8', errors='surrogateescape')
+        info['trailing_data'] = data.decode()
     return info
 
 def parse_bytestream(stream: typing.BinaryIO, info: dict) -> dict:
@@ -708,7 +927,7 @@ def main(args):
     for arg in args:
         if arg == '-':
             info = parse_bytestream(sys.stdin.buffer, {})
-            print(json.dumps(info, indent=4))
+            print(json.dumps(info, indent=4, default=str))
         else:
             raise NotImplementedError("fetch not implemented")
 